@@ -12,191 +12,419 @@ analysis and visualization in Kibana. The goal is to ensure that every Saturday
 data is consistently made available for decision-makers to monitor key employee metrics like attrition, 
 travel behavior, and departmental stats, all without manual intervention.
 
-Schedule  : Runs every Saturday at 09:10, 09:20, and 09:30 AM (GMT+7) to ensure timely updates and fallback 
-redundancy in case of failure.
+Schedule  : Runs every Saturday at 09:10 AM (GMT+7). Fallback redundancy in case of failure comes from 
+Airflow's own retries. Every run loads a fresh index and only then swaps it in, so Kibana always shows 
+exactly the latest cleaned data and a failed or retried run never leaves partial or duplicate documents.
 
 ------------------------------------------------------------------------------------------------------------
 """
 
 # Importing Libraries
+import itertools
+import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
 import re
+import threading
 from datetime import datetime, timedelta
+from functools import lru_cache
 from sqlalchemy import create_engine
 from airflow import DAG
 from airflow.decorators import task
+from airflow.exceptions import AirflowException
 from airflow.operators.empty import EmptyOperator
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import parallel_bulk
+from elasticsearch.serializer import JSONSerializer
+
+try:
+    import orjson
+except ImportError:     # fall back to the client's stdlib json serializer
+    orjson = None
+
+# Define a lazily-built, pooled engine that is reused by every task run within a worker process
+@lru_cache(maxsize=None)
+def get_engine():
+    """
+    Builds the SQLAlchemy engine for the airflow PostgreSQL database once per process.
+    The engine is not picklable, so it is created lazily inside each forked Airflow worker
+    instead of at DAG parse time.
+
+    Args:
+        None
+
+    Returns:
+        sqlalchemy.engine.Engine: Pooled engine connected to the airflow database
+
+    Example:
+        with get_engine().begin() as conn:
+            ...
+    """
+
+    database = "airflow"
+    username = "airflow"
+    password = "airflow"
+    host = "host.docker.internal"
+    port = "5434"
+
+    postgres_url = f"postgresql+psycopg2://{username}:{password}@{host}:{port}/{database}"
+
+    return create_engine(
+        postgres_url,
+        pool_size=5,            # keep up to 5 idle connections open for reuse
+        max_overflow=5,         # allow 5 extra connections under load
+        pool_pre_ping=True,     # drop stale connections before handing them out
+        pool_use_lifo=True,     # reuse the most recently returned connection first
+        pool_recycle=1800       # recycle connections older than 30 minutes
+    )
+
+# Define an orjson-backed serializer for the elasticsearch client
+class OrjsonSerializer(JSONSerializer):
+    """
+    Serializes request bodies and deserializes responses with orjson, which is several times faster 
+    than the stdlib json module on plain dicts. The bulk helpers call `dumps` once per action and once 
+    per document, so this is where most of the producer CPU goes.
+
+    Example:
+        Elasticsearch(["http://elasticsearch:9200/"], serializer=OrjsonSerializer())
+    """
+
+    def dumps(self, data):
+        # bulk helpers pass pre-serialized strings through untouched
+        if isinstance(data, str):
+            return data
+        return orjson.dumps(data, default=self.default).decode('utf-8')
+
+    def loads(self, s):
+        return orjson.loads(s)
+
+# Map postgresql type OIDs to arrow types so the COPY output is parsed without dtype inference
+_PG_TO_ARROW = {
+    16: pa.bool_(),         # boolean
+    20: pa.int64(),         # bigint
+    21: pa.int16(),         # smallint
+    23: pa.int32(),         # integer / serial
+    25: pa.string(),        # text
+    700: pa.float32(),      # real
+    701: pa.float64(),      # double precision
+    1043: pa.string(),      # varchar
+}
+
+# Precompile the column name patterns once so normalize_columns() reuses them on every run
+_RE_NONALNUM = re.compile(r'[^A-Za-z0-9]')          # symbols/tabs
+_RE_SPLIT = re.compile(
+    r'(?<=[a-zA-Z])(?=[0-9])'                       # boundary between letters and digits
+    r'|(?<=[0-9])(?=[a-zA-Z])'                      # boundary between digits and letters
+    r'|(?<=[a-z])(?=[A-Z])'                         # boundary before uppercase letters
+)
+_RE_DUP_US = re.compile(r'_+')                      # runs of underscores
+
+# Define the function for normalizing all column names at once
+def normalize_columns(columns):
+    """
+    Normalizes a whole set of column names in one vectorized pass by:
+    - Stripping whitespaces
+    - Replacing symbols/tabs with underscores
+    - Inserting underscores between letters and numbers
+    - Inserting underscores before uppercase letters
+    - Removing redundant underscores
+    - Lowercasing all characters
+
+    Args:
+        columns (Iterable[str]): Original column names, e.g. df.columns
+
+    Returns:
+        pd.Index: Normalized column names in snake_case
+
+    Example:
+        normalize_columns([" ID ", "numCompaniesWorked"]) -> Index(["id", "num_companies_worked"])
+    """
+
+    return (
+        pd.Index(columns).str
+        .strip()                                        # remove leading/trailing whitespace if any
+        .str.replace(_RE_NONALNUM, '_', regex=True)     # replace symbols/tabs if any with underscore
+        .str.replace(_RE_SPLIT, '_', regex=True)        # insert underscore at letter/digit and camelCase boundaries
+        .str.replace(_RE_DUP_US, '_', regex=True)       # collapse multiple underscores if any into one
+        .str.strip('_')                                 # remove leading/trailing underscores if any
+        .str.lower()                                    # convert everything to lowercase for consistency
+    )
 
 # Define the DAG's default args
 default_args= {
     'owner': 'Ian',
     'start_date': datetime(2024, 11, 1) - timedelta(hours=7),   # convert runtime log to GMT+7
-    'retries': 1,                                               # rerun if there's a failed task 1 time
-    'retry_delay': timedelta(minutes=5)
+    'retries': 3,                                               # rerun if there's a failed task up to 3 times
+    'retry_delay': timedelta(minutes=10),
+    'execution_timeout': timedelta(minutes=8)                   # fail a hung run so the retry can take over
 }
 
 # Define the DAG's parameters
 with DAG(
     'P2M3_rd_ladityarsa_ilyankusuma_DAG',
     description='Sequential flow from PostgreSQL to Elasticsearch and Kibana',
-    schedule_interval='10,20,30 9 * * 6',   # scheduled at minute 10, 20, and 30 past hour 9 on Saturday
+    schedule_interval='10 9 * * 6',         # scheduled at minute 10 past hour 9 on Saturday
     default_args=default_args, 
     catchup=False
 ) as dag:
 
     start = EmptyOperator(task_id='start')
 
-    # === Task 1: Fetching the dataset from a postgresql database and inserting it to docker as a csv file ===
+    # === Task: Extract from postgresql, clean in memory, and index to elasticsearch in one pass ===
     @task()
-    def fetch_from_postgresql():
+    def etl_hr():
         """
-        This task function extracts raw data from a PostgreSQL table and saves it to a CSV file 
-        in the local Airflow container.
+        This task function runs the whole pipeline in memory as a single straight-line ETL:
+        1. Extracts the HR data from a PostgreSQL table, with rows containing missing values already 
+           removed by the database. The query result is streamed with PostgreSQL's 
+           `COPY ... TO STDOUT` through a pipe and parsed incrementally into Arrow record batches.
+        2. Normalizes the column names of every batch.
+        3. Indexes the cleaned rows to Elasticsearch in batches through the bulk API, dispatching 
+           chunks from a small thread pool. Every document uses the row's "id" primary key as its 
+           `_id`, so duplicates collapse at ingest. Each run loads a fresh "index_m3_<timestamp>" index 
+           and swaps the "index_m3" alias over to it only after a complete load, dropping the previous 
+           indices, so rows deleted from the table or now containing nulls disappear from Kibana too.
+        Each batch is also appended to the published clean CSV, which the Great Expectations suite 
+        validates, as it passes through, so peak memory is bounded by the batch size rather than the 
+        size of the table.
 
         Args:
             None directly, but assumes:
                 - A running PostgreSQL database named "airflow"
                 - Accessible via host.docker.internal:5434
                 - Table name: 'table_m3'
+                - Elasticsearch running at http://elasticsearch:9200/
+                - Target index: "index_m3", an alias of the latest "index_m3_<timestamp>" index
 
         Returns:
-            None. Saves a CSV file to /opt/airflow/data/P2M3_rd_ladityarsa_ilyankusuma_data_raw.csv
-
-        Example:
-            # DAG execution
-            fetch_from_postgresql()
-        """
-
-        database = "airflow"
-        username = "airflow"
-        password = "airflow"
-        host = "host.docker.internal"
-        port = "5434"
-
-        postgres_url = f"postgresql+psycopg2://{username}:{password}@{host}:{port}/{database}"
-
-        engine = create_engine(postgres_url)
-        conn = engine.connect()
-
-        # Read the dataset from our airflow database using sql as df
-        df = pd.read_sql('select * from table_m3', conn)
-
-        # Save the raw dataset as a csv file
-        df.to_csv('/opt/airflow/data/HR_employee_attrition_dataset_raw.csv', index=False)
-
-        print("Inserting data is SUCCESS")
-
-    # === Task 2: Preprocess the dataset such as duplicates handling and save it to a new csv file ===
-    @task()
-    def data_cleaning():
-        """
-        This task function cleans the dataset by removing duplicates, handling missing values, 
-        and normalizing column names.
-        Saves the cleaned dataset as a new CSV file.
-
-        Args:
-            None. Expects the raw CSV file to be present at:
-                /opt/airflow/data/HR_employee_attrition_dataset_raw.csv
-
-        Returns:
-            None. Saves the cleaned dataset to:
+            None. Saves a snapshot of the cleaned dataset to:
                 /opt/airflow/data/HR_employee_attrition_dataset_clean.csv
+            and prints the number of indexed and failed documents.
 
         Example:
             # DAG execution
-            data_cleaning()
+            etl_hr()
         """
 
-        # Read the saved raw dataset csv file as df
-        df = pd.read_csv('/opt/airflow/data/HR_employee_attrition_dataset_raw.csv')
-        
-        # Remove duplicates if any
-        df.drop_duplicates(inplace=True)
-
-        # Remove missing values if any
-        df.dropna(inplace=True)
+        # === Extract ===
 
-        # Reset dropped index
-        df.reset_index(drop=True, inplace=True)
+        # Let postgresql remove rows with any missing value (t IS NOT NULL); no DISTINCT is needed since
+        # "ID" is the primary key and elasticsearch deduplicates on the matching document _id
+        query = 'SELECT * FROM table_m3 t WHERE t IS NOT NULL'
 
-        # Normalize column names
+        # Read the column types from the catalog without fetching any row
+        with get_engine().begin() as conn:
+            with conn.connection.cursor() as cur:
+                cur.execute('SELECT * FROM table_m3 LIMIT 0')
+                column_types = {
+                    c.name: _PG_TO_ARROW[c.type_code]
+                    for c in cur.description
+                    if c.type_code in _PG_TO_ARROW
+                }
 
-        ## Create the function for normalizing the column names
-        def normalize(col):
+        ## Create the function that streams the COPY output into the write end of a pipe
+        def copy_to_pipe(sink, errors, closing):
             """
-            Normalizes column names by:
-            - Stripping whitespaces
-            - Replacing symbols/tabs with underscores
-            - Inserting underscores between letters and numbers
-            - Inserting underscores before uppercase letters
-            - Removing redundant underscores
-            - Lowercasing all characters
+            Runs `COPY ... TO STDOUT` and writes the CSV output into `sink` as postgresql sends it.
+            Meant to run in a background thread while the read end of the pipe is being parsed.
 
             Args:
-                col (str): Original column name
+                sink (io.BufferedWriter): Write end of the pipe, closed once COPY finishes
+                errors (list): Collects any exception raised so the caller can re-raise it
+                closing (threading.Event): Set by the caller right before it closes the read end
 
             Returns:
-                str: Normalized column name in snake_case
-
-            Example:
-                normalize(" ID ")               -> "id"
-                normalize("numCompaniesWorked") -> "num_companies_worked"
-                normalize("over18__")           -> "over_18"
-                normalize("Monthly$Income")     -> "monthly_income"
+                None
             """
 
-            col = col.strip()                                   # remove leading/trailing whitespace if any
-            col = re.sub(r'[^A-Za-z0-9]', '_', col)             # replace symbols/tabs if any with underscore
-            col = re.sub(r'(?<=[a-zA-Z])(?=[0-9])', '_', col)   # insert underscore between letters and digits
-            col = re.sub(r'(?<=[0-9])(?=[a-zA-Z])', '_', col)   # insert underscore between digits and letters
-            col = re.sub(r'(?<=[a-z])(?=[A-Z])', '_', col)      # insert underscore before uppercase letters
-            col = re.sub(r'_+', '_', col)                       # collapse multiple underscores if any into one
-            col = col.strip('_')                                # remove leading/trailing underscores if any
-            col = col.lower()                                   # convert everything to lowercase for consistency
-            return col                                          # return the celaned column name
-        
-        ## Dynamically normalize all column names using the function
-        df.columns = [normalize(col) for col in df.columns]
-
-        print("Preprocessing data is SUCCESS")
-        print(df.head())
-
-        # Save the cleaned dataset as a new csv file
-        df.to_csv('/opt/airflow/data/HR_employee_attrition_dataset_clean.csv', index=False)
-
-    # === Task 3: Secure a kibana connection with elasticsearch from our docker container for indexing ===
-    @task()
-    def post_to_elasticsearch():
-        """
-        Indexes each row of the cleaned dataset to Elasticsearch as individual JSON documents.
-
-        Args:
-            None. Reads from:
-                /opt/airflow/data/HR_employee_attrition_dataset_clean.csv
-            Assumes:
-                - Elasticsearch running at http://elasticsearch:9200/
-                - Target index: "index_m3"
-                - doc_type: "doc"
-
-        Returns:
-            None. Prints Elasticsearch response for each row.
-
-        Example:
-            # DAG execution
-            post_to_elasticsearch()
-        """
-
-        es = Elasticsearch(["http://elasticsearch:9200/"]) 
-
-        # Read the saved clean dataset csv file as df
-        df = pd.read_csv('/opt/airflow/data/HR_employee_attrition_dataset_clean.csv')
-
-        # Convert the dataset to json and send it to elasticsearch
-        for i, r in df.iterrows():
-            doc=r.to_json()
-            res=es.index(index="index_m3", doc_type="doc", body=doc)
-            print(res)
+            try:
+                with sink, get_engine().begin() as conn:
+                    with conn.connection.cursor() as cur:
+                        cur.copy_expert(f'COPY ({query}) TO STDOUT WITH CSV HEADER', sink)
+            except OSError as e:
+                # A broken pipe after the caller closed the read end is a side effect, not a COPY error
+                if not closing.is_set():
+                    errors.append(e)
+            except Exception as e:
+                errors.append(e)
+
+        # Stream the dataset out of our airflow database with COPY through a pipe
+        read_fd, write_fd = os.pipe()
+        source = open(read_fd, 'rb')
+        copy_errors = []
+        closing = threading.Event()
+        copier = threading.Thread(target=copy_to_pipe, args=(open(write_fd, 'wb'), copy_errors, closing))
+        copier.start()
+
+        # Write the snapshot next to the published one and only swap it in after a successful load
+        snapshot_path = '/opt/airflow/data/HR_employee_attrition_dataset_clean.csv'
+        snapshot_tmp = snapshot_path + '.tmp'
+
+        error = None
+        try:
+            # Parse the pipe incrementally as arrow record batches with the database's own column types
+            reader = pv.open_csv(
+                source,
+                read_options=pv.ReadOptions(use_threads=True, block_size=8 * 1024 * 1024),
+                convert_options=pv.ConvertOptions(column_types=column_types)
+            )
+
+            # === Transform ===
+
+            # Normalize all column names in a single vectorized pass
+            names = list(normalize_columns(reader.schema.names))
+            schema = pa.schema([field.with_name(name) for field, name in zip(reader.schema, names)])
+
+            batches = (pa.RecordBatch.from_arrays(batch.columns, schema=schema) for batch in reader)
+            first = next(batches, None)
+
+            print("Preprocessing data is SUCCESS")
+            if first is not None:
+                print(first.slice(0, 5).to_pandas())
+                batches = itertools.chain([first], batches)
+
+            # === Load ===
+
+            # Load every run into a fresh index, the "index_m3" alias is only moved once it is complete
+            index_name = f"index_m3_{datetime.utcnow():%Y%m%d%H%M%S}"
+
+            es = Elasticsearch(
+                ["http://elasticsearch:9200/"],
+                maxsize=8,              # keep-alive connection pool larger than the bulk thread count
+                http_compress=True,     # gzip request bodies, HR JSON is highly repetitive
+                timeout=120,            # long enough that a large bulk chunk does not time out midway
+                retry_on_timeout=True,  # retry a timed out request instead of failing the task
+                max_retries=3,
+                serializer=OrjsonSerializer() if orjson else JSONSerializer()
+            )
+
+            ## Create the generator that turns every row into a bulk index action
+            def generate_actions(batches, writer, chunk=1000):
+                """
+                Yields one bulk index action per row of the cleaned dataset.
+                Each record batch is appended to the clean CSV snapshot, then converted to plain dicts 
+                one slice at a time, so the next slice is only materialized once the previous one 
+                has been sent.
+
+                Args:
+                    batches (Iterable[pa.RecordBatch]): Cleaned dataset, one batch at a time
+                    writer (io.TextIOWrapper): Open file of the clean CSV snapshot
+                    chunk (int): Number of rows converted per slice
+
+                Yields:
+                    dict: Bulk action targeting this run's index, keyed by the row's "id" so that 
+                    duplicate rows collapse into a single document
+                """
+
+                for batch in batches:
+                    batch.to_pandas().to_csv(writer, header=writer.tell() == 0, index=False)
+                    for i in range(0, batch.num_rows, chunk):
+                        for record in batch.slice(i, chunk).to_pylist():
+                            yield {"_op_type": "index", "_index": index_name, "_id": str(record["id"]), "_source": record}
+
+            ## Derive the index mappings from the cleaned schema so they always follow normalize_columns()
+            properties = {}
+            for field in schema:
+                if pa.types.is_int64(field.type):
+                    properties[field.name] = {"type": "long"}
+                elif pa.types.is_integer(field.type):
+                    properties[field.name] = {"type": "integer"}
+                elif pa.types.is_float32(field.type):
+                    properties[field.name] = {"type": "float"}
+                elif pa.types.is_floating(field.type):
+                    properties[field.name] = {"type": "double"}
+                elif pa.types.is_boolean(field.type):
+                    properties[field.name] = {"type": "boolean"}
+                elif pa.types.is_temporal(field.type):
+                    properties[field.name] = {"type": "date"}
+                else:
+                    properties[field.name] = {"type": "keyword"}
+
+            ## Create this run's index with strict mappings
+            es.indices.create(
+                index=index_name,
+                body={
+                    "settings": {"number_of_shards": 1, "refresh_interval": "-1"},
+                    "mappings": {"dynamic": "strict", "properties": properties}
+                }
+            )
+
+            # Disable refresh and replicas during the load so segments are not flushed every second
+            es.indices.put_settings(
+                index=index_name,
+                body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}}
+            )
+
+            # Send the dataset to elasticsearch from 4 threads in chunks of ~1000 documents / 10MB per request
+            success, failed = 0, 0
+            load_error = None
+            try:
+                with open(snapshot_tmp, 'w', newline='') as writer:
+                    for ok, info in parallel_bulk(
+                        es,
+                        generate_actions(batches, writer),
+                        thread_count=4,
+                        queue_size=4,
+                        chunk_size=1000,
+                        max_chunk_bytes=10 * 1024 * 1024,
+                        raise_on_error=False
+                    ):
+                        if ok:
+                            success += 1
+                        else:
+                            failed += 1
+                            print(info)
+            except Exception as e:
+                load_error = e
+                raise
+            finally:
+                # Restore refresh and replicas even if the load failed, then compact the new segments
+                try:
+                    es.indices.put_settings(
+                        index=index_name,
+                        body={"index": {"refresh_interval": "30s", "number_of_replicas": 1}}
+                    )
+                    es.indices.forcemerge(index=index_name, max_num_segments=5)
+                except Exception as e:
+                    # Only log it when the load already failed, so the original error is the one raised
+                    if load_error is None:
+                        raise
+                    print(f"Restoring index settings failed: {e!r}")
+        except Exception as e:
+            error = e
+        finally:
+            # Close the read end first so a blocked COPY fails fast instead of hanging the join
+            closing.set()
+            source.close()
+            copier.join()
+
+        # A failed COPY surfaces in the parser as a truncated CSV, or not at all when it is cut on a line
+        # boundary, so the COPY error always takes precedence over whatever it caused
+        if copy_errors:
+            raise copy_errors[0] from error
+        if error is not None:
+            raise error
+
+        # Fail the task on rejected documents so Airflow's retries kick in instead of a silent partial load
+        if failed:
+            raise AirflowException(f"Indexing data is FAILED: {success} indexed, {failed} failed")
+
+        # Publish the snapshot only now that the whole dataset has been extracted and indexed
+        os.replace(snapshot_tmp, snapshot_path)
+
+        # Point the "index_m3" alias read by Kibana at this run's index now that it is fully loaded, and drop
+        # the previous indices (including ones left behind by failed attempts) in the same atomic update
+        old_indices = [name for name in es.indices.get(index="index_m3_*") if name != index_name]
+        if not es.indices.exists_alias(name="index_m3") and es.indices.exists(index="index_m3"):
+            # Legacy concrete index with dynamic mappings and auto-generated ids from the old triple cron runs
+            old_indices.append("index_m3")
+
+        actions = [{"add": {"index": index_name, "alias": "index_m3"}}]
+        actions += [{"remove_index": {"index": name}} for name in old_indices]
+        es.indices.update_aliases(body={"actions": actions})
+
+        print(f"Indexing data is SUCCESS: {success} indexed, {failed} failed")
 
     end = EmptyOperator(task_id='end')
 
@@ -205,11 +433,12 @@ with DAG(
     
     Execution flow:
     1. `start`: EmptyOperator that marks the beginning of the DAG
-    2. `fetch_from_postgresql()`: Extracts raw data from PostgreSQL and saves it to a CSV file
-    3. `data_cleaning()`: Cleans the raw data (duplicates, missing values, and column normalization)
-    4. `post_to_elasticsearch()`: Loads the cleaned data to Elasticsearch for Kibana indexing
-    5. `end`: EmptyOperator that marks the end of the DAG execution
+    2. `etl_hr()`: Extracts non-null data from PostgreSQL, normalizes the column names, and loads the 
+       cleaned data to Elasticsearch for Kibana indexing, all in memory, deduplicating on the "id" 
+       primary key through the document _id
+    3. `end`: EmptyOperator that marks the end of the DAG execution
     
-    This sequential flow ensures strict dependency enforcement between each ETL step
+    Keeping the whole ETL in one task avoids writing and re-reading intermediate files between steps, 
+    while Airflow's retries still rerun the pipeline as a unit
     """
-    start >> fetch_from_postgresql() >> data_cleaning() >> post_to_elasticsearch() >> end
\ No newline at end of file
+    start >> etl_hr() >> end
\ No newline at end of file